@@ -2,19 +2,29 @@
 Integrated Thermal Image Analyzer
 Uses specialized solar panel fault detection models from Web-API
 """
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from PIL import Image
+from collections import OrderedDict
+import gzip
+import hashlib
 import io
-import json
+import threading
 import numpy as np
-from os import fspath
+import orjson
+from os import fspath, getenv
 from pathlib import Path
 from dotenv import load_dotenv
-from tensorflow.keras.models import load_model
 
 # Import Web-API utilities
-from utils.utils import get_yolo_boxes, disconnected
+from utils.batching import MicroBatcher
+from utils.utils import (
+    boxes_to_arrays,
+    compile_model,
+    disconnected,
+    get_yolo_boxes_multi,
+    merge_models,
+)
 from utils.colors import get_color
 import cv2
 
@@ -35,6 +45,18 @@ class ModelManager:
     net_h, net_w = 416, 416
     obj_thresh, nms_thresh = 0.5, 0.45
     
+    # "keras" (default) or "tensorrt" for GPU hosts with TensorRT installed
+    backend = getenv("INFERENCE_BACKEND", "keras").lower()
+    # TensorRT precision: "fp16" or "int8" (calibrated on storage/calib/)
+    precision = getenv("TENSORRT_PRECISION", "fp16").lower()
+    # Concurrent requests are stacked into batches of up to this many images;
+    # there are never more than one per gunicorn request thread
+    max_batch_size = int(getenv("MAX_BATCH_SIZE", getenv("WEB_THREADS", "4")))
+    # TensorRT execution contexts (each with its own profile and CUDA stream)
+    trt_streams = int(getenv("TENSORRT_STREAMS", "3"))
+    # With every request thread busy, each stream's batcher gets about this many
+    trt_opt_batch_size = -(-max_batch_size // trt_streams)
+    
     model_compiled = {
         "model_1": fspath(storage_path.joinpath("model/yolo3_full_fault_1.h5")),
         "model_2": fspath(storage_path.joinpath("model/yolo3_full_fault_4.h5")),
@@ -53,34 +75,79 @@ class ModelManager:
         ),
     }
     
-    _models = None
+    _model = None
     _models_loaded = False
     _configs_loaded = None
+    # Lazy loading can start on several request threads at once
+    _models_lock = threading.Lock()
+    _configs_lock = threading.Lock()
+    # Flat per-model references, filled once by _load_configs
+    label_names = {}
+    anchors = {}
     
     @classmethod
     def _load_models(cls):
         """Load models once (lazy initialization)"""
-        if not cls._models_loaded:
-            print("Loading solar panel fault detection models...")
+        if cls._models_loaded:
+            return cls._model
+        with cls._models_lock:
+            if cls._models_loaded:
+                return cls._model
+            print(f"Loading solar panel fault detection models ({cls.backend})...")
+            model_paths = [cls.model_compiled[key] for key in cls.model_compiled]
             try:
-                cls._models = {
-                    "model_1": load_model(cls.model_compiled["model_1"]),
-                    "model_2": load_model(cls.model_compiled["model_2"]),
-                    "model_3": load_model(cls.model_compiled["model_3"]),
-                }
+                # The three models are merged into one multi-head model so each
+                # request runs a single forward pass over a shared input
+                if cls.backend == "tensorrt":
+                    from utils.trt_engine import load_trt_model
+                    cls._model = load_trt_model(
+                        model_paths,
+                        cls.net_h,
+                        cls.net_w,
+                        num_streams=cls.trt_streams,
+                        precision=cls.precision,
+                        calib_dir=storage_path.joinpath("calib"),
+                        max_batch_size=cls.max_batch_size,
+                        opt_batch_size=cls.trt_opt_batch_size,
+                    )
+                else:
+                    # TensorFlow is only imported once models are actually needed
+                    from tensorflow.keras.models import load_model
+                    cls._model = merge_models(
+                        [load_model(path) for path in model_paths],
+                        cls.net_h,
+                        cls.net_w,
+                    )
+                    try:
+                        cls._model = compile_model(
+                            cls._model, cls.net_h, cls.net_w, cls.max_batch_size
+                        )
+                    except Exception as e:
+                        print(f"Warning: XLA compilation failed, using Keras predict: {e}")
+                if cls.max_batch_size > 1:
+                    # One batching thread per TensorRT context keeps every stream busy
+                    num_workers = cls.trt_streams if cls.backend == "tensorrt" else 1
+                    cls._model = MicroBatcher(
+                        cls._model, cls.max_batch_size, num_workers=num_workers
+                    )
                 cls._models_loaded = True
                 print("✓ All models loaded successfully")
             except Exception as e:
                 print(f"✗ Error loading models: {e}")
                 print("Make sure model files are in storage/model/ directory")
                 raise
-        return cls._models
+        return cls._model
     
     @classmethod
     def _load_configs(cls):
         """Load model configurations"""
-        if cls._configs_loaded is None:
-            cls._configs_loaded = {}
+        if cls._configs_loaded is not None:
+            return cls._configs_loaded
+        with cls._configs_lock:
+            if cls._configs_loaded is not None:
+                return cls._configs_loaded
+            # Only published once complete, readers never see a partial dict
+            configs = {}
             for key, config_path in cls.model_config.items():
                 try:
                     # Resolve to absolute path for better error messages
@@ -88,26 +155,32 @@ class ModelManager:
                     if not abs_path.exists():
                         print(f"Warning: Config file not found: {abs_path}")
                         print(f"  Expected at: {config_path}")
-                        cls._configs_loaded[key] = None
+                        configs[key] = None
                     else:
-                        with open(abs_path) as f:
-                            cls._configs_loaded[key] = json.load(f)
-                            print(f"✓ Loaded config: {key} from {abs_path}")
+                        config = orjson.loads(abs_path.read_bytes())
+                        configs[key] = config
+                        print(f"✓ Loaded config: {key} from {abs_path}")
+                        # Object array so label indices map to names in one fancy-index
+                        cls.label_names[key] = np.asarray(
+                            config["model"]["labels"], dtype=object
+                        )
+                        cls.anchors[key] = config["model"]["anchors"]
                 except FileNotFoundError as e:
                     print(f"Warning: Config file not found: {config_path}")
                     print(f"  Error: {e}")
-                    cls._configs_loaded[key] = None
-                except json.JSONDecodeError as e:
+                    configs[key] = None
+                except orjson.JSONDecodeError as e:
                     print(f"Error: Invalid JSON in config file {config_path}: {e}")
-                    cls._configs_loaded[key] = None
+                    configs[key] = None
                 except Exception as e:
                     print(f"Error loading config {key} from {config_path}: {e}")
-                    cls._configs_loaded[key] = None
+                    configs[key] = None
+            cls._configs_loaded = configs
         return cls._configs_loaded
     
     @property
-    def models(self):
-        """Access to models (lazy loading)"""
+    def model(self):
+        """Access to the merged model (lazy loading)"""
         return self._load_models()
     
     @property
@@ -118,10 +191,50 @@ class ModelManager:
 
 model_manager = ModelManager()
 
+# Encoded /analyze responses keyed by the SHA-256 of the uploaded bytes, so
+# repeated uploads of the same image skip decoding and inference
+RESPONSE_CACHE_SIZE = 128
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def get_cached_response(key):
+    """Return the cached ``[body, gzipped]`` entry for ``key`` (or None), marking it recent"""
+    with _response_cache_lock:
+        encoded = _response_cache.get(key)
+        if encoded is not None:
+            _response_cache.move_to_end(key)
+        return encoded
+
+
+def cache_response(key, encoded):
+    """Store a ``[body, gzipped]`` entry, evicting the least recently used beyond the limit"""
+    with _response_cache_lock:
+        _response_cache[key] = encoded
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+# Bodies below this size are sent as is, gzip framing would not pay off
+GZIP_MIN_SIZE = 1024
 
-def pil_to_numpy(image):
-    """Convert PIL Image to numpy array (RGB format)"""
-    return np.array(image)
+
+def json_response(encoded):
+    """
+    Response for a ``[body, gzipped]`` entry, gzipped when the client accepts it.
+    The body is compressed on the first such request and the gzipped bytes are
+    kept in the entry, so later cache hits reuse them
+    """
+    body = encoded[0]
+    response = Response(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if len(body) >= GZIP_MIN_SIZE and "gzip" in request.accept_encodings:
+        if encoded[1] is None:
+            encoded[1] = gzip.compress(body, compresslevel=6)
+        response.set_data(encoded[1])
+        response.headers["Content-Encoding"] = "gzip"
+    return response
 
 
 def numpy_to_pil(image_array):
@@ -129,51 +242,70 @@ def numpy_to_pil(image_array):
     return Image.fromarray(image_array.astype('uint8'))
 
 
-def transform_detections_to_frontend_format(objects):
+# libjpeg can decode directly at 1/8, 1/4 or 1/2 scale during the IDCT
+JPEG_REDUCED_MODES = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def imdecode_flags(image_info, net_h, net_w):
+    """
+    cv2.imdecode flags for an upload: large JPEGs are decoded at the smallest
+    scale that still covers the letterboxed network input
+    """
+    flags = cv2.IMREAD_IGNORE_ORIENTATION
+    if image_info["format"] == "JPEG":
+        max_factor = max(image_info["width"] / net_w, image_info["height"] / net_h)
+        for factor, mode in JPEG_REDUCED_MODES:
+            if factor <= max_factor:
+                return flags | mode
+    return flags | cv2.IMREAD_COLOR
+
+
+def lookup_label_names(names, label_idx):
+    """Map label indices to names, falling back to Class_<index> when out of range"""
+    n = len(names)
+    found = names[np.clip(label_idx, 0, n - 1)]
+    return np.where(label_idx < n, found, np.char.add("Class_", label_idx.astype(str)))
+
+
+def transform_detections_to_frontend_format(coords, scores, labels, classes):
     """
-    Transform Web-API detection format to frontend format
+    Transform Web-API detection arrays to frontend format
     
-    Web-API format: {xmin, xmax, ymin, ymax, label, score, class}
+    Web-API arrays: coords (N, 4) as [xmin, ymin, xmax, ymax], scores, labels, classes (N,)
     Frontend format: {label, confidence, coordinates: [x, y, width, height], severity}
     """
-    detections = []
+    coords = np.asarray(coords, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
     
-    for obj in objects:
-        xmin = obj.get("xmin", 0)
-        ymin = obj.get("ymin", 0)
-        xmax = obj.get("xmax", 0)
-        ymax = obj.get("ymax", 0)
-        
-        # Convert to [x, y, width, height] format
-        x = float(xmin)
-        y = float(ymin)
-        width = float(xmax - xmin)
-        height = float(ymax - ymin)
-        
-        # Get confidence score
-        score_str = obj.get("score", "0")
-        try:
-            confidence = float(score_str)
-        except (ValueError, TypeError):
-            confidence = 0.0
-        
-        # Determine severity based on confidence
-        if confidence > 0.8:
-            severity = "High"
-        elif confidence > 0.5:
-            severity = "Medium"
-        else:
-            severity = "Low"
-        
-        detections.append({
-            "label": obj.get("label", "Unknown"),
-            "confidence": round(confidence, 2),
-            "coordinates": [x, y, width, height],
-            "severity": severity,
-            "class": obj.get("class", ""),
-        })
+    # Convert to [x, y, width, height] format
+    boxes = coords.copy()
+    boxes[:, 2:] -= coords[:, :2]
     
-    return detections
+    # Determine severity based on confidence
+    severity = np.select([scores > 0.8, scores > 0.5], ["High", "Medium"], "Low")
+    confidence = np.round(scores, 2)
+    
+    # Coordinates stay float32 array rows; orjson serializes them natively
+    return [
+        {
+            "label": label,
+            "confidence": conf,
+            "coordinates": box,
+            "severity": sev,
+            "class": cls,
+        }
+        for label, conf, box, sev, cls in zip(
+            np.asarray(labels, dtype=object).tolist(),
+            confidence.tolist(),
+            boxes,
+            severity.tolist(),
+            np.asarray(classes, dtype=object).tolist(),
+        )
+    ]
 
 
 @app.route("/", methods=["GET"])
@@ -202,8 +334,14 @@ def analyze_image():
         if file.filename == '':
             return jsonify({"error": "No file selected"}), 400
         
-        # Read image data
+        # Read image data and serve repeated uploads from the response cache
         image_data = file.read()
+        cache_key = hashlib.sha256(image_data).digest()
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            return json_response(cached)
+        
+        # PIL only parses the header here, for metadata
         pil_image = Image.open(io.BytesIO(image_data))
         
         # Collect image metadata
@@ -215,18 +353,27 @@ def analyze_image():
             "height": pil_image.height
         }
         
-        # Convert PIL to numpy array (RGB format)
-        image_array = pil_to_numpy(pil_image)
+        # Decode straight to a contiguous 3-channel uint8 array (grayscale and
+        # alpha are normalized by the decoder), keeping pixels in stored order.
+        # Large JPEGs are decoded at reduced scale since the models only see
+        # the net_h x net_w letterbox anyway
+        image_array = cv2.imdecode(
+            np.frombuffer(image_data, np.uint8),
+            imdecode_flags(image_info, model_manager.net_h, model_manager.net_w),
+        )
+        if image_array is not None:
+            # Convert to RGB format
+            image_array = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+        else:
+            # OpenCV has no decoder for some formats PIL reads (e.g. GIF)
+            try:
+                image_array = np.array(pil_image.convert("RGB"))
+            except OSError:
+                return jsonify({"error": f"Unsupported image format: {image_info['format']}"}), 400
         
-        # Ensure image is in RGB format (3 channels)
-        if len(image_array.shape) == 2:
-            # Grayscale, convert to RGB
-            image_array = cv2.cvtColor(image_array, cv2.COLOR_GRAY2RGB)
-        elif image_array.shape[2] == 4:
-            # RGBA, convert to RGB
-            image_array = cv2.cvtColor(image_array, cv2.COLOR_RGBA2RGB)
-        elif image_array.shape[2] != 3:
-            return jsonify({"error": f"Unsupported image format: {image_array.shape}"}), 400
+        # Scale from decoded to original pixel coordinates
+        scale_x = image_info["width"] / image_array.shape[1]
+        scale_y = image_info["height"] / image_array.shape[0]
         
         # Prepare images list (Web-API expects list)
         images = [image_array]
@@ -239,106 +386,62 @@ def analyze_image():
                 "message": "Please ensure config files are in storage/model/config/"
             }), 500
         
-        # Extract labels from configs
-        labels_1 = configs["model_1"]["model"]["labels"]
-        labels_2 = configs["model_2"]["model"]["labels"]
-        labels_3 = configs["model_3"]["model"]["labels"]
-        
-        # Get models
-        models = model_manager.models
-        
-        # Run inference with all three models
-        boxes_p_1 = get_yolo_boxes(
-            models["model_1"],
-            images,
-            model_manager.net_h,
-            model_manager.net_w,
-            configs["model_1"]["model"]["anchors"],
-            model_manager.obj_thresh,
-            model_manager.nms_thresh,
-        )
+        # Get merged model
+        model = model_manager.model
         
-        boxes_p_2 = get_yolo_boxes(
-            models["model_2"],
+        # Run inference with all three models in a single pass
+        boxes_p_1, boxes_p_2, boxes_p_3 = get_yolo_boxes_multi(
+            model,
             images,
             model_manager.net_h,
             model_manager.net_w,
-            configs["model_2"]["model"]["anchors"],
+            [
+                model_manager.anchors["model_1"],
+                model_manager.anchors["model_2"],
+                model_manager.anchors["model_3"],
+            ],
             model_manager.obj_thresh,
             model_manager.nms_thresh,
         )
         
-        boxes_p_3 = get_yolo_boxes(
-            models["model_3"],
-            images,
-            model_manager.net_h,
-            model_manager.net_w,
-            configs["model_3"]["model"]["anchors"],
-            model_manager.obj_thresh,
-            model_manager.nms_thresh,
-        )
+        # Pack model_1/model_2 boxes into arrays and filter by confidence threshold
+        obj_thresh = model_manager.obj_thresh
+        coords_1, scores_1, label_idx_1 = boxes_to_arrays(boxes_p_1[0])
+        keep_1 = scores_1 > obj_thresh
+        coords_2, scores_2, label_idx_2 = boxes_to_arrays(boxes_p_2[0])
+        keep_2 = scores_2 > obj_thresh
         
-        # Filter boxes by confidence threshold
-        boxes_p_1 = [
-            [box for box in boxes_image if box.get_score() > model_manager.obj_thresh]
-            for boxes_image in boxes_p_1
-        ]
-        boxes_p_2 = [
-            [box for box in boxes_image if box.get_score() > model_manager.obj_thresh]
-            for boxes_image in boxes_p_2
-        ]
+        # Apply special processing for panel disconnect (model_3)
         boxes_p_3 = [
-            [box for box in boxes_image if box.get_score() > model_manager.obj_thresh]
+            [box for box in boxes_image if box.get_score() > obj_thresh]
             for boxes_image in boxes_p_3
         ]
-        
-        # Apply special processing for panel disconnect (model_3)
         boxes_p_3 = [
-            disconnected(image, boxes_image)
+            disconnected(image, boxes_image, area_min=400 / (scale_x * scale_y))
             for image, boxes_image in zip(images, boxes_p_3)
         ]
+        coords_3, scores_3, label_idx_3 = boxes_to_arrays(boxes_p_3[0], score_index=0)
         
-        # Collect all detections
-        all_objects = []
-        
-        # Process model_1 detections (Soiling Fault)
-        for box in boxes_p_1[0]:
-            all_objects.append({
-                "class": labels_1[box.get_label()],
-                "label": "Soiling Fault",
-                "score": str(box.get_score()),
-                "xmin": box.xmin,
-                "xmax": box.xmax,
-                "ymin": box.ymin,
-                "ymax": box.ymax,
-            })
-        
-        # Process model_2 detections (Diode Fault)
-        for box in boxes_p_2[0]:
-            all_objects.append({
-                "class": labels_2[box.get_label()],
-                "label": "Diode Fault",
-                "score": str(box.get_score()),
-                "xmin": box.xmin,
-                "xmax": box.xmax,
-                "ymin": box.ymin,
-                "ymax": box.ymax,
-            })
-        
-        # Process model_3 detections (Panel Disconnect)
-        for box in boxes_p_3[0]:
-            all_objects.append({
-                "class": labels_3[box.get_label()],
-                "label": "Panel Disconnect",
-                "score": str(box.classes[0]),
-                "xmin": box.xmin,
-                "xmax": box.xmax,
-                "ymin": box.ymin,
-                "ymax": box.ymax,
-            })
+        # Collect all detections (Soiling Fault, Diode Fault, Panel Disconnect)
+        label_idx_1, label_idx_2 = label_idx_1[keep_1], label_idx_2[keep_2]
+        coords = np.concatenate([coords_1[keep_1], coords_2[keep_2], coords_3])
+        coords *= np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        scores = np.concatenate([scores_1[keep_1], scores_2[keep_2], scores_3])
+        labels = np.repeat(
+            ["Soiling Fault", "Diode Fault", "Panel Disconnect"],
+            [len(label_idx_1), len(label_idx_2), len(label_idx_3)],
+        )
+        label_names = model_manager.label_names
+        classes = np.concatenate([
+            lookup_label_names(label_names["model_1"], label_idx_1),
+            lookup_label_names(label_names["model_2"], label_idx_2),
+            lookup_label_names(label_names["model_3"], label_idx_3),
+        ])
         
         # Transform to frontend format
-        detections = transform_detections_to_frontend_format(all_objects)
+        detections = transform_detections_to_frontend_format(
+            coords, scores, labels, classes
+        )
         
         # Build response
         response = {
@@ -359,7 +462,11 @@ def analyze_image():
                 "are in good condition, or the image may need adjustment."
             )
         
-        return jsonify(response)
+        body = orjson.dumps(response, option=orjson.OPT_SERIALIZE_NUMPY)
+        # The gzipped form is filled in by json_response once a client wants it
+        encoded = [body, None]
+        cache_response(cache_key, encoded)
+        return json_response(encoded)
         
     except Exception as e:
         import traceback
@@ -372,13 +479,16 @@ def analyze_image():
         }), 500
 
 
-# Pre-load models on startup (for both direct run and gunicorn)
-try:
-    model_manager._load_models()
-    model_manager._load_configs()
-except Exception as e:
-    print(f"Warning: Could not pre-load models: {e}")
-    print("Models will be loaded on first request")
+# Pre-load models on startup (for both direct run and gunicorn), unless
+# PRELOAD_MODELS=false defers TensorFlow and the models to the first /analyze
+if getenv("PRELOAD_MODELS", "true").lower() not in ("false", "0", "no"):
+    try:
+        model_manager._load_models()
+        model_manager._load_configs()
+    except Exception as e:
+        print(f"Warning: Could not pre-load models: {e}")
+        print("Models will be loaded on first request")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # The reloader would import this module (and load the models) a second time
+    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False, threaded=True)
@@ -5,8 +5,17 @@ This script sends the image to the backend /analyze endpoint and displays result
 """
 
 import sys
-import json
+import argparse
+import atexit
+import functools
+import mimetypes
+import orjson
 import requests
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.retry import Retry
 from pathlib import Path
 from datetime import datetime
 
@@ -14,13 +23,63 @@ from datetime import datetime
 IMAGE_PATH = "000001.jpg"
 BACKEND_URL = "http://localhost:5000"
 OUTPUT_FILE = "thermal_analysis_results.json"
+BATCH_CONCURRENCY = 8
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# (connect, read) timeouts: a dead backend fails fast, inference keeps its full budget
+HEALTH_TIMEOUT = (3.05, 5)
+ANALYZE_TIMEOUT = (3.05, 60)
+
+# Report separators
+_EQ = "=" * 70
+_DASH = "-" * 70
+_BANNER = f"\n{_EQ}\nTHERMAL ANALYSIS RESULTS\n{_EQ}\n"
+
+# Detection fields read by the report, with their defaults already applied
+Det = namedtuple("Det", "label confidence severity coords")
+
+# One pooled session shared by every upload
+SESSION = requests.Session()
+
+
+def mount_adapter(pool_maxsize: int):
+    """(Re)mount the session's retrying adapter with room for pool_maxsize sockets"""
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            # Hand the last 5xx back to the caller, which reports the status code
+            raise_on_status=False,
+        ),
+    )
+    for prefix in ("http://", "https://"):
+        if prefix in SESSION.adapters:
+            SESSION.adapters[prefix].close()
+        SESSION.mount(prefix, adapter)
+
+
+mount_adapter(4)
+atexit.register(SESSION.close)
+
+
+@functools.lru_cache(maxsize=32)
+def _image_meta(path: str, mtime_ns: int, size: int) -> tuple[str, str, str]:
+    """Upload file name, content type and display size, cached until the file changes"""
+    name = Path(path).name
+    content_type = mimetypes.guess_type(name)[0] or 'image/jpeg'
+    return name, content_type, f"{size / 1024:.2f} KB"
 
 
 def check_server(base_url: str) -> bool:
     """Check if the backend server is running"""
     print("Checking server connection...")
     try:
-        response = requests.get(f"{base_url}/", timeout=5)
+        response = SESSION.get(f"{base_url}/", timeout=HEALTH_TIMEOUT)
         if response.status_code == 200:
             print(f"✓ Server is online at {base_url}")
             print(f"  Status: {response.json()}")
@@ -29,9 +88,11 @@ def check_server(base_url: str) -> bool:
             print(f"✗ Server returned status {response.status_code}")
             return False
     except requests.exceptions.ConnectionError:
-        print(f"✗ Cannot connect to server at {base_url}")
-        print("  Make sure the server is running:")
-        print("  uv run python main.py")
+        sys.stdout.write(
+            f"✗ Cannot connect to server at {base_url}\n"
+            "  Make sure the server is running:\n"
+            "  uv run python main.py\n"
+        )
         return False
     except Exception as e:
         print(f"✗ Error connecting to server: {e}")
@@ -42,165 +103,207 @@ def analyze_thermal_image(image_path: str, base_url: str) -> dict | None:
     """Analyze the thermal image using the backend API"""
     print(f"\nAnalyzing thermal image: {image_path}")
     
-    if not Path(image_path).exists():
+    # A single stat() covers both the existence check and the file size
+    path = Path(image_path)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
         print(f"✗ Image file not found: {image_path}")
         return None
     
-    # Get image file size
-    file_size = Path(image_path).stat().st_size
-    print(f"  Image size: {file_size / 1024:.2f} KB")
+    name, content_type, size_kb = _image_meta(image_path, st.st_mtime_ns, st.st_size)
+    print(f"  Image size: {size_kb}")
     
     try:
         print("  Uploading image to backend...")
-        with open(image_path, 'rb') as f:
-            files = {'file': (Path(image_path).name, f, 'image/jpeg')}
-            response = requests.post(
+        with open(path, 'rb') as f:
+            # Stream the multipart body from the file instead of building it in memory
+            encoder = MultipartEncoder(
+                fields={'file': (name, f, content_type)}
+            )
+            response = SESSION.post(
                 f"{base_url}/analyze",
-                files=files,
-                timeout=60  # Longer timeout for image processing
+                data=encoder,
+                headers={'Content-Type': encoder.content_type},
+                timeout=ANALYZE_TIMEOUT
             )
         
         if response.status_code == 200:
-            result = response.json()
+            # Decode straight from the response bytes
+            result = orjson.loads(response.content)
             print("✓ Analysis completed successfully")
             return result
         else:
             print(f"✗ Server returned status {response.status_code}")
             print(f"  Response: {response.text}")
             return None
-    except requests.exceptions.Timeout:
+    except requests.exceptions.ConnectTimeout:
+        print(f"✗ Timed out connecting to {base_url}. Check the backend URL and network.")
+        return None
+    except requests.exceptions.ReadTimeout:
         print("✗ Request timed out. The image may be too large or processing is taking too long.")
         return None
+    except requests.exceptions.ConnectionError:
+        # No separate health check round trip, a refused upload means the server
+        # is down; the caller decides whether that ends the run
+        print(f"✗ Cannot connect to server at {base_url}")
+        raise
     except Exception as e:
         print(f"✗ Error during analysis: {e}")
         return None
 
 
+def _fmt_detection(i: int, label, conf, sev, coords) -> str:
+    """Detail lines for one detection, from already-defaulted Det fields"""
+    text = f"\n{i}. {label}\n   Confidence: {conf:.2%}\n   Severity: {sev}\n"
+    if coords and len(coords) >= 4:
+        # Format each value once, both lines reuse the rounded strings
+        x, y, width, height = ["{:.0f}".format(v) for v in coords[:4]]
+        text += (f"   Location: x={x}, y={y}, width={width}, height={height}\n"
+                 f"   Bounding Box: [{x}, {y}, {width}, {height}]\n")
+    return text
+
+
 def display_results(result: dict):
     """Display the analysis results in a formatted way"""
-    print("\n" + "=" * 70)
-    print("THERMAL ANALYSIS RESULTS")
-    print("=" * 70)
+    # Collect the report and write it out in one go instead of line by line
+    buf = []
+    w = buf.append
+    w(_BANNER)
     
     # Display image information
     if 'image_info' in result:
         img_info = result['image_info']
-        print("\nImage Information:")
-        print(f"  Dimensions: {img_info.get('width')} x {img_info.get('height')} pixels")
-        print(f"  Format: {img_info.get('format', 'Unknown')}")
-        print(f"  Color Mode: {img_info.get('mode', 'Unknown')}")
+        w("\nImage Information:\n")
+        w(f"  Dimensions: {img_info.get('width')} x {img_info.get('height')} pixels\n")
+        w(f"  Format: {img_info.get('format', 'Unknown')}\n")
+        w(f"  Color Mode: {img_info.get('mode', 'Unknown')}\n")
     
     # Display model information
     if 'model_info' in result:
         model_info = result['model_info']
-        print("\nModel Information:")
-        print(f"  Model: {model_info.get('model', 'Unknown')}")
-        print(f"  Type: {model_info.get('model_type', 'Unknown')}")
+        w("\nModel Information:\n")
+        w(f"  Model: {model_info.get('model', 'Unknown')}\n")
+        w(f"  Type: {model_info.get('model_type', 'Unknown')}\n")
         if 'note' in model_info:
-            print(f"  Note: {model_info['note']}")
+            w(f"  Note: {model_info['note']}\n")
     
     # Display warning if present
     if 'warning' in result:
-        print("\n⚠ WARNING:")
-        print(f"  {result['warning']}")
+        w("\n⚠ WARNING:\n")
+        w(f"  {result['warning']}\n")
     
     # Get detections from either 'detections' or 'analysis' field
     detections = result.get('detections', result.get('analysis', []))
+    detections = [
+        Det(d.get('label', 'Unknown'), d.get('confidence', 0),
+            d.get('severity', 'Unknown'), d.get('coordinates', ()))
+        for d in detections
+    ]
     
     if not detections:
-        print("\n⚠ No detections found in the image")
-        print("  This could mean:")
-        print("  - The model didn't detect any objects in this thermal image")
-        print("  - The image may not contain recognizable thermal patterns")
-        print("  - The confidence threshold may be too high")
-        print("\n  💡 Note: The thermal model is configured with confidence threshold 0.25")
-        print("     You may want to adjust the model parameters in main.py if needed.")
+        w("\n⚠ No detections found in the image\n")
+        w("  This could mean:\n")
+        w("  - The model didn't detect any objects in this thermal image\n")
+        w("  - The image may not contain recognizable thermal patterns\n")
+        w("  - The confidence threshold may be too high\n")
+        w("\n  💡 Note: The thermal model is configured with confidence threshold 0.25\n")
+        w("     You may want to adjust the model parameters in main.py if needed.\n")
+        sys.stdout.write("".join(buf))
         return
     
-    print(f"\nTotal Detections: {len(detections)}")
-    print("-" * 70)
+    w(f"\nTotal Detections: {len(detections)}\n")
+    w(_DASH + "\n")
     
-    # Group by label
-    by_label = {}
+    # Group by label in a single pass: [count, confidence sum, high severity count]
+    by_label = defaultdict(lambda: [0, 0.0, 0])
     for det in detections:
-        label = det.get('label', 'Unknown')
-        if label not in by_label:
-            by_label[label] = []
-        by_label[label].append(det)
+        stats = by_label[det.label]
+        stats[0] += 1
+        stats[1] += det.confidence
+        stats[2] += det.severity == 'High'
     
     # Display summary by label
-    print("\nSummary by Detection Type:")
-    for label, items in sorted(by_label.items()):
-        avg_conf = sum(d.get('confidence', 0) for d in items) / len(items)
-        high_severity = sum(1 for d in items if d.get('severity') == 'High')
-        print(f"  {label}: {len(items)} detection(s), avg confidence: {avg_conf:.2%}, "
-              f"high severity: {high_severity}")
+    w("\nSummary by Detection Type:\n")
+    for label, (count, conf_sum, high_severity) in sorted(by_label.items()):
+        avg_conf = conf_sum / count
+        w(f"  {label}: {count} detection(s), avg confidence: {avg_conf:.2%}, "
+          f"high severity: {high_severity}\n")
     
     # Display detailed detections
-    print("\nDetailed Detections:")
-    print("-" * 70)
+    w("\nDetailed Detections:\n")
+    w(_DASH + "\n")
     for i, det in enumerate(detections, 1):
-        label = det.get('label', 'Unknown')
-        confidence = det.get('confidence', 0)
-        severity = det.get('severity', 'Unknown')
-        coords = det.get('coordinates', [])
-        
-        print(f"\n{i}. {label}")
-        print(f"   Confidence: {confidence:.2%}")
-        print(f"   Severity: {severity}")
-        if coords and len(coords) >= 4:
-            x, y, width, height = coords[:4]
-            print(f"   Location: x={x:.0f}, y={y:.0f}, width={width:.0f}, height={height:.0f}")
-            print(f"   Bounding Box: [{x:.0f}, {y:.0f}, {width:.0f}, {height:.0f}]")
+        w(_fmt_detection(i, *det))
     
-    print("\n" + "=" * 70)
+    w(f"\n{_EQ}\n")
+    sys.stdout.write("".join(buf))
 
 
-def save_results(result: dict, output_file: str, image_path: str = None, backend_url: str = None):
-    """Save results to a JSON file"""
+def save_results(result: dict, output_file: str, image_path: str = None, backend_url: str = None,
+                 pretty: bool = False, quiet: bool = False) -> str:
+    """Save results to a JSON file, compact unless pretty is set.
+    Returns the status line, which is also printed unless quiet is set."""
     output_data = {
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": datetime.now(),  # orjson writes it in ISO 8601 format
         "image_path": image_path or IMAGE_PATH,
         "backend_url": backend_url or BACKEND_URL,
         "analysis": result
     }
     
     try:
-        with open(output_file, 'w') as f:
-            json.dump(output_data, f, indent=2)
-        print(f"\n✓ Results saved to: {output_file}")
+        option = orjson.OPT_INDENT_2 if pretty else None
+        Path(output_file).write_bytes(orjson.dumps(output_data, option=option))
+        status = f"\n✓ Results saved to: {output_file}"
     except Exception as e:
-        print(f"\n⚠ Could not save results to file: {e}")
+        status = f"\n⚠ Could not save results to file: {e}"
+    if not quiet:
+        print(status)
+    return status
 
 
-def main(image_path: str = None, backend_url: str = None):
+def exit_server_down():
+    """Print how to start the backend and exit with an error"""
+    sys.stdout.write(
+        "\n⚠ Please start the server first:\n"
+        "   uv run python main.py\n"
+    )
+    sys.exit(1)
+
+
+def main(image_path: str = IMAGE_PATH, backend_url: str = BACKEND_URL, health: bool = False,
+         pretty: bool = False):
     """Main test function"""
-    # Use provided values or defaults
-    img_path = image_path or IMAGE_PATH
-    backend = backend_url or BACKEND_URL
-    
-    print("=" * 70)
+    print(_EQ)
     print("THERMAL IMAGE ANALYSIS TEST")
-    print("=" * 70)
-    print(f"Image: {img_path}")
-    print(f"Backend: {backend}")
+    print(_EQ)
+    print(f"Image: {image_path}")
+    print(f"Backend: {backend_url}")
     print(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
-    # Check if server is running
-    if not check_server(backend):
-        print("\n⚠ Please start the server first:")
-        print("   uv run python main.py")
-        sys.exit(1)
+    # Optional health check, analyze_thermal_image reports a down server on its own
+    if health and not check_server(backend_url):
+        exit_server_down()
     
     # Analyze the image
-    result = analyze_thermal_image(img_path, backend)
+    try:
+        result = analyze_thermal_image(image_path, backend_url)
+    except requests.exceptions.ConnectionError:
+        exit_server_down()
     
     if result:
-        # Display results
-        display_results(result)
-        
-        # Save results
-        save_results(result, OUTPUT_FILE, img_path, backend)
+        # Write the results file in the background while the report is printed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            saved = executor.submit(
+                save_results, result, OUTPUT_FILE, image_path, backend_url, pretty,
+                quiet=True
+            )
+            
+            # Display results
+            display_results(result)
+            
+            # The status line is printed after the report so output order is stable
+            print(saved.result())
         
         print("\n✓ Test completed successfully!")
     else:
@@ -208,18 +311,79 @@ def main(image_path: str = None, backend_url: str = None):
         sys.exit(1)
 
 
-if __name__ == "__main__":
-    # Allow custom image path and backend URL via command line
-    # Usage: python test_thermal_image.py [image_path] [backend_url]
-    image_path = None
-    backend_url = None
+def main_batch(paths: list, backend_url: str = BACKEND_URL,
+               concurrency: int = BATCH_CONCURRENCY, health: bool = False,
+               pretty: bool = False):
+    """Analyze several images concurrently, saving each result next to its image"""
+    print(_EQ)
+    print(f"THERMAL IMAGE BATCH ANALYSIS ({len(paths)} images)")
+    print(_EQ)
+    print(f"Backend: {backend_url}")
+    print(f"Concurrency: {concurrency}")
     
-    if len(sys.argv) > 1:
-        image_path = sys.argv[1]
-        print(f"Using custom image: {image_path}")
-    if len(sys.argv) > 2:
-        backend_url = sys.argv[2]
-        print(f"Using custom backend URL: {backend_url}")
+    if health and not check_server(backend_url):
+        exit_server_down()
     
-    main(image_path, backend_url)
+    # Uploads share SESSION, with one pooled socket per concurrent upload
+    mount_adapter(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(analyze_thermal_image, path, backend_url) for path in paths]
+        failed = 0
+        server_down = False
+        for path, future in zip(paths, futures):
+            try:
+                result = future.result()
+            except requests.exceptions.ConnectionError:
+                result = None
+                server_down = True
+            if result:
+                save_results(result, f"{path}.json", path, backend_url, pretty)
+            else:
+                failed += 1
+    
+    if failed:
+        print(f"\n✗ {failed} of {len(paths)} images could not be analyzed")
+        if server_down:
+            exit_server_down()
+        sys.exit(1)
+    print(f"\n✓ Analyzed {len(paths)} images successfully!")
+
+
+def _positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 
+if __name__ == "__main__":
+    # Usage: python test_thermal_image.py [--health] [--pretty] [image_path|image_dir] [backend_url]
+    parser = argparse.ArgumentParser(description="Analyze a thermal image with the backend API")
+    parser.add_argument("image_path", nargs="?", default=IMAGE_PATH,
+                        help=f"image, or directory of images, to analyze (default: {IMAGE_PATH})")
+    parser.add_argument("backend_url", nargs="?", default=BACKEND_URL,
+                        help=f"backend base URL (default: {BACKEND_URL})")
+    parser.add_argument("--health", action="store_true",
+                        help="check the server before uploading")
+    parser.add_argument("--pretty", action="store_true",
+                        help="indent the saved JSON results")
+    parser.add_argument("--concurrency", type=_positive_int, default=BATCH_CONCURRENCY,
+                        help=f"parallel uploads for a directory (default: {BATCH_CONCURRENCY})")
+    args = parser.parse_args()
+    
+    image_dir = Path(args.image_path)
+    if image_dir.is_dir():
+        paths = sorted(
+            str(path) for path in image_dir.iterdir()
+            if path.suffix.lower() in IMAGE_EXTENSIONS
+        )
+        main_batch(paths, args.backend_url, args.concurrency, args.health, args.pretty)
+        sys.exit(0)
+    
+    if args.image_path != IMAGE_PATH:
+        print(f"Using custom image: {args.image_path}")
+    if args.backend_url != BACKEND_URL:
+        print(f"Using custom backend URL: {args.backend_url}")
+    
+    main(args.image_path, args.backend_url, args.health, args.pretty)
@@ -0,0 +1,81 @@
+"""Tests for utils.batching.MicroBatcher with a stub model"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from utils.batching import MicroBatcher
+
+
+class StubModel:
+    """Returns two outputs derived from the input and records batch sizes"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    def predict_on_batch(self, batch_input):
+        with self.lock:
+            self.batch_sizes.append(len(batch_input))
+        time.sleep(self.delay)
+        return [batch_input * 2, batch_input[:, :1] + 1]
+
+
+def call_concurrently(batcher, inputs):
+    results = [None] * len(inputs)
+
+    def call(i):
+        try:
+            results[i] = batcher.predict_on_batch(inputs[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    return results
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_each_caller_gets_its_own_slices(num_workers):
+    model = StubModel(delay=0.02)
+    batcher = MicroBatcher(model, max_batch_size=4, max_latency=0.05, num_workers=num_workers)
+    inputs = [np.full((1, 3), i, dtype=np.float32) for i in range(20)]
+
+    results = call_concurrently(batcher, inputs)
+
+    for batch_input, (doubled, first_plus_one) in zip(inputs, results):
+        np.testing.assert_array_equal(doubled, batch_input * 2)
+        np.testing.assert_array_equal(first_plus_one, batch_input[:, :1] + 1)
+    assert sum(model.batch_sizes) == len(inputs)
+    assert max(model.batch_sizes) <= 4
+    assert max(model.batch_sizes) > 1
+
+
+def test_multi_image_requests_are_not_split():
+    model = StubModel()
+    batcher = MicroBatcher(model, max_batch_size=4, max_latency=0.05)
+    inputs = [np.full((3, 2), i, dtype=np.float32) for i in range(4)]
+
+    results = call_concurrently(batcher, inputs)
+
+    for batch_input, (doubled, _) in zip(inputs, results):
+        np.testing.assert_array_equal(doubled, batch_input * 2)
+    assert all(size == 3 for size in model.batch_sizes)
+
+
+def test_errors_reach_callers_and_worker_survives():
+    batcher = MicroBatcher(StubModel(), max_batch_size=4, max_latency=0.05)
+
+    # Inputs that cannot be concatenated fail the batch before the model runs
+    results = call_concurrently(
+        batcher, [np.zeros((1, 2)), np.zeros((1, 3))]
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+
+    doubled, _ = batcher.predict_on_batch(np.ones((1, 2)))
+    np.testing.assert_array_equal(doubled, [[2, 2]])
@@ -0,0 +1,161 @@
+"""
+Regression tests for the vectorized YOLO decoding and NMS in utils.utils,
+checked against the original per-box loops on fixed random network outputs.
+"""
+import copy
+
+import numpy as np
+import pytest
+
+from utils.bbox import BoundBox, bbox_iou
+from utils.utils import (
+    _sigmoid,
+    _softmax,
+    boxes_to_arrays,
+    decode_netout,
+    do_nms,
+)
+
+ANCHORS = [10, 13, 16, 30, 33, 23]
+NET_H, NET_W = 416, 416
+OBJ_THRESH, NMS_THRESH = 0.5, 0.45
+
+
+def reference_decode_netout(netout, anchors, obj_thresh, net_h, net_w):
+    """The original loop implementation, with NumPy in place of tf ops"""
+    grid_h, grid_w = netout.shape[:2]
+    nb_box = 3
+    netout = netout.reshape((grid_h, grid_w, nb_box, -1))
+
+    aux_1 = _sigmoid(netout[..., :2])
+    aux_2 = _sigmoid(netout[..., 4])
+    aux_3 = aux_2[..., np.newaxis] * _softmax(netout[..., 5:])
+    aux_4 = aux_3 * (aux_3 > obj_thresh)
+    netout = np.concatenate(
+        [aux_1, netout[..., 2:4], aux_2[..., np.newaxis], aux_4], 3
+    )
+
+    boxes = []
+    for i in range(grid_h * grid_w):
+        row = i // grid_w
+        col = i % grid_w
+
+        for b in range(nb_box):
+            objectness = netout[row, col, b, 4]
+
+            if objectness <= obj_thresh:
+                continue
+
+            x, y, w, h = netout[row, col, b, :4]
+
+            x = (col + x) / grid_w
+            y = (row + y) / grid_h
+            w = anchors[2 * b + 0] * np.exp(w) / net_w
+            h = anchors[2 * b + 1] * np.exp(h) / net_h
+
+            classes = np.array(netout[row, col, b, 5:])
+
+            boxes.append(
+                BoundBox(
+                    x - w / 2, y - h / 2, x + w / 2, y + h / 2, objectness, classes
+                )
+            )
+
+    return boxes
+
+
+def reference_do_nms(boxes, nms_thresh):
+    """The original pairwise bbox_iou suppression loop"""
+    if len(boxes) > 0:
+        nb_class = len(boxes[0].classes)
+    else:
+        return
+
+    for c in range(nb_class):
+        sorted_indices = np.argsort([-box.classes[c] for box in boxes])
+
+        for i in range(len(sorted_indices)):
+            index_i = sorted_indices[i]
+
+            if boxes[index_i].classes[c] == 0:
+                continue
+
+            for j in range(i + 1, len(sorted_indices)):
+                index_j = sorted_indices[j]
+
+                if bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
+                    boxes[index_j].classes[c] = 0
+
+
+def random_netout(seed, grid=13, nb_class=2):
+    rng = np.random.RandomState(seed)
+    netout = rng.normal(size=(grid, grid, 3 * (5 + nb_class))).astype(np.float32)
+    # bias objectness up so plenty of overlapping boxes pass the threshold
+    netout.reshape((grid, grid, 3, -1))[..., 4] += 1.0
+    return netout
+
+
+def box_rows(boxes):
+    return np.array(
+        [[box.xmin, box.ymin, box.xmax, box.ymax, box.c] for box in boxes]
+    ).reshape((-1, 5))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_decode_netout_matches_reference(seed):
+    netout = random_netout(seed)
+
+    boxes = decode_netout(netout, ANCHORS, OBJ_THRESH, NET_H, NET_W)
+    expected = reference_decode_netout(netout, ANCHORS, OBJ_THRESH, NET_H, NET_W)
+
+    assert len(boxes) == len(expected) > 0
+    np.testing.assert_allclose(
+        box_rows(boxes), box_rows(expected), rtol=1e-5, atol=1e-6
+    )
+    np.testing.assert_allclose(
+        [box.classes for box in boxes],
+        [box.classes for box in expected],
+        rtol=1e-5,
+        atol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_do_nms_matches_reference(seed):
+    boxes = decode_netout(random_netout(seed), ANCHORS, OBJ_THRESH, NET_H, NET_W)
+    expected = copy.deepcopy(boxes)
+
+    do_nms(boxes, NMS_THRESH)
+    reference_do_nms(expected, NMS_THRESH)
+
+    suppressed = np.array([box.classes for box in boxes])
+    assert (suppressed == 0).any()
+    np.testing.assert_array_equal(suppressed, [box.classes for box in expected])
+
+
+def test_do_nms_without_boxes():
+    boxes = []
+    do_nms(boxes, NMS_THRESH)
+    assert boxes == []
+
+
+def test_boxes_to_arrays():
+    boxes = [
+        BoundBox(1, 2, 3, 4, 0.9, np.array([0.2, 0.7])),
+        BoundBox(5, 6, 7, 8, 0.8, np.array([0.6, 0.1])),
+    ]
+
+    coords, scores, labels = boxes_to_arrays(boxes)
+    np.testing.assert_array_equal(coords, [[1, 2, 3, 4], [5, 6, 7, 8]])
+    assert coords.dtype == np.float32
+    np.testing.assert_allclose(scores, [0.7, 0.6])
+    np.testing.assert_array_equal(labels, [1, 0])
+
+    _, scores, _ = boxes_to_arrays(boxes, score_index=0)
+    np.testing.assert_allclose(scores, [0.2, 0.6])
+
+
+def test_boxes_to_arrays_empty():
+    coords, scores, labels = boxes_to_arrays([])
+    assert coords.shape == (0, 4)
+    assert scores.shape == labels.shape == (0,)
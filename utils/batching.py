@@ -0,0 +1,89 @@
+"""
+Micro-batching for concurrent inference requests.
+
+Requests arriving within a short window are stacked into one batch and run
+through a single ``predict_on_batch`` call; each caller gets back its own slice
+of every output.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Wraps a model behind the same ``predict_on_batch`` interface, merging calls
+    from concurrent request threads into batches of at most ``max_batch_size``.
+    A lone request waits at most ``max_latency`` seconds for company.
+
+    ``num_workers`` threads assemble and run batches independently, so a model
+    that supports concurrent calls (e.g. ``TrtModel`` with several streams)
+    gets that many batches in flight.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_latency=0.01, num_workers=1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._workers = [
+            threading.Thread(target=self._run, name=f"micro-batcher-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def predict_on_batch(self, batch_input):
+        future = Future()
+        self._queue.put((batch_input, future))
+        return future.result()
+
+    def _run(self):
+        # A request that did not fit the previous batch opens this worker's next one
+        pending = None
+        while True:
+            if pending is None:
+                pending = self._queue.get()
+            requests, pending = [pending], None
+            try:
+                pending = self._collect(requests)
+                self._predict(requests)
+            except Exception as e:
+                # Never leave callers blocked on a batch this worker gave up on
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _collect(self, requests):
+        """Add queued requests to ``requests`` until the batch is full or the
+        deadline passes; returns a request that did not fit, if any"""
+        size = len(requests[0][0])
+        deadline = time.monotonic() + self.max_latency
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(request[0]) > self.max_batch_size:
+                return request
+            requests.append(request)
+            size += len(request[0])
+        return None
+
+    def _predict(self, requests):
+        batch_output = self.model.predict_on_batch(
+            np.concatenate([batch for batch, _ in requests])
+        )
+
+        start = 0
+        for batch, future in requests:
+            end = start + len(batch)
+            future.set_result([output[start:end] for output in batch_output])
+            start = end
@@ -0,0 +1,382 @@
+"""
+TensorRT inference backend for the Keras YOLOv3 models.
+
+The ``.h5`` models are merged into one multi-head Keras model (see
+``utils.utils.merge_models``), exported once to ONNX and built into a single
+serialized FP16 (or INT8 with FP16 fallback) TensorRT engine stored in
+``storage/model/``. Engine files are keyed by the SHA-256 of the source ``.h5``
+files, the TensorRT version and the GPU model, so retrained weights, upgrades
+and new hardware trigger a rebuild.
+
+INT8 engines are calibrated on the thermal images in ``storage/calib/``; the
+resulting calibration table is cached as ``storage/model/*.cache``.
+
+The exported network takes a float32 0-255 input (normalized in-graph), since
+the ONNX parsers of many TensorRT 8.x releases reject UINT8 network inputs.
+The host-side batch stays uint8 and is widened when copied into the pinned
+input buffer.
+
+Requires ``tensorrt``, ``pycuda`` and ``tf2onnx``, which are only installed on
+GPU hosts, so everything is imported lazily.
+"""
+import hashlib
+import os
+import queue
+from pathlib import Path
+
+import numpy as np
+
+CALIB_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff"}
+
+_cuda_context = None
+
+
+class StaleEngineError(RuntimeError):
+    """A cached engine that this TensorRT runtime cannot deserialize"""
+
+
+def file_digest(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def platform_tag():
+    """TensorRT version and GPU model, which a serialized engine is tied to"""
+    import pycuda.driver as cuda
+    import tensorrt as trt
+
+    cuda_context()
+    return f"{trt.__version__}/{cuda.Device(0).name()}"
+
+
+def engine_path_for(model_paths, name, suffix=".plan", platform=""):
+    sha = hashlib.sha256()
+    for model_path in model_paths:
+        sha.update(file_digest(model_path).encode())
+    sha.update(platform.encode())
+    digest = sha.hexdigest()[:16]
+    return Path(model_paths[0]).with_name(f"{name}-{digest}{suffix}")
+
+
+def export_onnx(model, onnx_path, net_h, net_w):
+    import tensorflow as tf
+    import tf2onnx
+
+    input_signature = (
+        tf.TensorSpec((None, net_h, net_w, 3), tf.float32, name="input"),
+    )
+    tf2onnx.convert.from_keras(
+        model, input_signature=input_signature, opset=13, output_path=str(onnx_path)
+    )
+
+
+def make_calibrator(image_dir, cache_path, net_h, net_w, max_images=1000):
+    """
+    Entropy calibrator feeding preprocessed thermal images from ``image_dir``.
+    Images are decoded to RGB and letterboxed exactly like ``/analyze`` does.
+    """
+    import cv2
+    import pycuda.driver as cuda
+    import tensorrt as trt
+    from utils.utils import letterbox_input
+
+    # Calibration runs on its own optimization profile with a batch of one
+    batch_size = 1
+
+    class EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+        def __init__(self):
+            trt.IInt8EntropyCalibrator2.__init__(self)
+            image_dir_path = Path(image_dir)
+            paths = []
+            if image_dir_path.is_dir():
+                paths = sorted(
+                    p
+                    for p in image_dir_path.iterdir()
+                    if p.suffix.lower() in CALIB_EXTENSIONS
+                )
+            self.paths = paths[:max_images]
+            self.cache_path = Path(cache_path)
+            self.batch = np.zeros((batch_size, net_h, net_w, 3), dtype=np.float32)
+            self.device = cuda.mem_alloc(self.batch.nbytes)
+            self.index = 0
+
+            if not self.paths and not self.cache_path.exists():
+                raise RuntimeError(
+                    f"INT8 calibration needs images in {image_dir} "
+                    f"or a calibration cache at {cache_path}"
+                )
+
+        def get_batch_size(self):
+            return batch_size
+
+        def get_batch(self, names):
+            if self.index + batch_size > len(self.paths):
+                return None
+            for i, path in enumerate(self.paths[self.index : self.index + batch_size]):
+                image = cv2.cvtColor(cv2.imread(str(path)), cv2.COLOR_BGR2RGB)
+                self.batch[i] = letterbox_input(image, net_h, net_w)[0]
+            self.index += batch_size
+            cuda.memcpy_htod(self.device, self.batch)
+            return [int(self.device)]
+
+        def read_calibration_cache(self):
+            if self.cache_path.exists():
+                return self.cache_path.read_bytes()
+            return None
+
+        def write_calibration_cache(self, cache):
+            self.cache_path.write_bytes(bytes(cache))
+
+    return EntropyCalibrator()
+
+
+def build_engine(
+    onnx_path,
+    engine_path,
+    workspace=1 << 30,
+    calibrator=None,
+    max_batch_size=1,
+    num_profiles=1,
+    opt_batch_size=None,
+):
+    import tensorrt as trt
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(
+        1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
+    )
+    parser = trt.OnnxParser(network, logger)
+
+    with open(onnx_path, "rb") as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError(f"Could not parse {onnx_path}: {'; '.join(errors)}")
+
+    config = builder.create_builder_config()
+    config.max_workspace_size = workspace
+    config.set_flag(trt.BuilderFlag.FP16)
+
+    # Dynamic batch dimension, tuned for the batch size expected in practice.
+    # Every concurrent execution context needs an optimization profile of its own
+    network_input = network.get_input(0)
+    image_shape = tuple(network_input.shape)[1:]
+    opt_batch_size = opt_batch_size or max_batch_size
+    for _ in range(num_profiles):
+        profile = builder.create_optimization_profile()
+        profile.set_shape(
+            network_input.name,
+            (1,) + image_shape,
+            (opt_batch_size,) + image_shape,
+            (max_batch_size,) + image_shape,
+        )
+        config.add_optimization_profile(profile)
+
+    if calibrator is not None:
+        # Layers without a good INT8 implementation fall back to FP16
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.int8_calibrator = calibrator
+        # Calibration batches hold a single image
+        calib_profile = builder.create_optimization_profile()
+        calib_profile.set_shape(network_input.name, *[(1,) + image_shape] * 3)
+        config.set_calibration_profile(calib_profile)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError(f"TensorRT engine build failed for {onnx_path}")
+
+    # Written aside and renamed, so a crash never leaves a truncated engine behind
+    tmp_path = Path(engine_path).with_name(Path(engine_path).name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(serialized)
+    os.replace(tmp_path, engine_path)
+
+
+def ensure_engine(
+    model_paths,
+    net_h,
+    net_w,
+    precision="fp16",
+    calib_dir=None,
+    max_batch_size=1,
+    num_profiles=1,
+    opt_batch_size=None,
+    name="yolo3_merged",
+):
+    """Return the cached merged engine for ``model_paths``, building it on first use"""
+    opt_batch_size = opt_batch_size or max_batch_size
+    engine_path = engine_path_for(
+        model_paths,
+        name,
+        suffix=f"-{precision}-b{opt_batch_size}-{max_batch_size}-p{num_profiles}.plan",
+        platform=platform_tag(),
+    )
+    if not engine_path.exists():
+        from tensorflow.keras.models import load_model
+        from utils.utils import merge_models
+
+        print(f"Building {precision} TensorRT engine {engine_path.name}...")
+        merged = merge_models(
+            [load_model(p) for p in model_paths], net_h, net_w, input_dtype="float32"
+        )
+        onnx_path = engine_path.with_suffix(".onnx")
+
+        ctx = cuda_context()
+        try:
+            export_onnx(merged, onnx_path, net_h, net_w)
+            ctx.push()
+            try:
+                calibrator = None
+                if precision == "int8":
+                    calibrator = make_calibrator(
+                        calib_dir, engine_path.with_suffix(".cache"), net_h, net_w
+                    )
+                build_engine(
+                    onnx_path,
+                    engine_path,
+                    calibrator=calibrator,
+                    max_batch_size=max_batch_size,
+                    num_profiles=num_profiles,
+                    opt_batch_size=opt_batch_size,
+                )
+            finally:
+                ctx.pop()
+        finally:
+            if onnx_path.exists():
+                onnx_path.unlink()
+    return engine_path
+
+
+def load_trt_model(model_paths, net_h, net_w, num_streams=3, **engine_options):
+    """
+    ``TrtModel`` over the cached engine for ``model_paths`` (see ``ensure_engine``),
+    rebuilding the engine once if the cached file cannot be deserialized
+    """
+    engine_options["num_profiles"] = num_streams
+    engine_path = ensure_engine(model_paths, net_h, net_w, **engine_options)
+    try:
+        return TrtModel(engine_path, num_streams=num_streams)
+    except StaleEngineError as e:
+        print(f"Warning: {e}, rebuilding")
+        engine_path.unlink()
+        engine_path = ensure_engine(model_paths, net_h, net_w, **engine_options)
+        return TrtModel(engine_path, num_streams=num_streams)
+
+
+def cuda_context():
+    """Process-wide CUDA context shared by every engine"""
+    global _cuda_context
+    if _cuda_context is None:
+        import atexit
+        import pycuda.driver as cuda
+
+        cuda.init()
+        _cuda_context = cuda.Device(0).make_context()
+        _cuda_context.pop()
+        atexit.register(_cuda_context.detach)
+    return _cuda_context
+
+
+class TrtModel:
+    """
+    Wraps a serialized TensorRT engine behind the Keras ``predict_on_batch``
+    interface so ``get_yolo_boxes_multi`` can use it unchanged.
+    Outputs are returned in network output order, as exported from Keras.
+
+    The engine is shared by ``num_streams`` execution contexts, each bound to
+    its own optimization profile (the engine must be built with at least
+    ``num_streams`` profiles) and with its own CUDA stream and page-locked
+    host/device buffers. Concurrent callers take a free context, so one batch's
+    copies overlap another's compute; behind a ``MicroBatcher`` this needs one
+    batching worker per stream.
+    Within a context, copies and inference are queued asynchronously and the
+    stream is synchronized once at the end.
+    """
+
+    def __init__(self, engine_path, num_streams=3):
+        import pycuda.driver as cuda
+        import tensorrt as trt
+
+        self._cuda = cuda
+        self._ctx = cuda_context()
+        self._slots = queue.Queue()
+        self._ctx.push()
+        try:
+            runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+            with open(engine_path, "rb") as f:
+                self.engine = runtime.deserialize_cuda_engine(f.read())
+            if self.engine is None:
+                raise StaleEngineError(f"Could not deserialize {engine_path}")
+            if self.engine.num_optimization_profiles < num_streams:
+                raise ValueError(
+                    f"{engine_path} has {self.engine.num_optimization_profiles} "
+                    f"optimization profiles, {num_streams} streams need one each"
+                )
+            for profile in range(num_streams):
+                self._slots.put(self._create_slot(cuda, trt, profile))
+        finally:
+            self._ctx.pop()
+
+    def _create_slot(self, cuda, trt, profile):
+        context = self.engine.create_execution_context()
+        context.active_optimization_profile = profile
+        slot = {
+            "context": context,
+            "stream": cuda.Stream(),
+            "inputs": [],
+            "outputs": [],
+            # Bindings of the other profiles stay unset
+            "bindings": [0] * self.engine.num_bindings,
+        }
+
+        # Binding indices of profile k are offset by k times the per-profile count
+        per_profile = self.engine.num_bindings // self.engine.num_optimization_profiles
+        indices = range(profile * per_profile, (profile + 1) * per_profile)
+
+        # Size every buffer for the largest batch of the optimization profile
+        for i in indices:
+            if self.engine.binding_is_input(i):
+                context.set_binding_shape(
+                    i, self.engine.get_profile_shape(profile, i)[2]
+                )
+
+        for i in indices:
+            shape = tuple(context.get_binding_shape(i))
+            dtype = trt.nptype(self.engine.get_binding_dtype(i))
+            host = cuda.pagelocked_empty(shape, dtype)
+            device = cuda.mem_alloc(host.nbytes)
+            slot["bindings"][i] = int(device)
+            if self.engine.binding_is_input(i):
+                slot["inputs"].append((i, host, device))
+            else:
+                slot["outputs"].append((host, device))
+        return slot
+
+    def predict_on_batch(self, batch_input):
+        cuda = self._cuda
+        slot = self._slots.get()
+        context, stream = slot["context"], slot["stream"]
+        index_in, host_in, device_in = slot["inputs"][0]
+        nb_images = len(batch_input)
+
+        try:
+            np.copyto(host_in[:nb_images], batch_input, casting="unsafe")
+            self._ctx.push()
+            try:
+                context.set_binding_shape(index_in, host_in[:nb_images].shape)
+                cuda.memcpy_htod_async(device_in, host_in[:nb_images], stream)
+                context.execute_async_v2(
+                    slot["bindings"], stream_handle=stream.handle
+                )
+                for host, device in slot["outputs"]:
+                    cuda.memcpy_dtoh_async(host[:nb_images], device, stream)
+                stream.synchronize()
+            finally:
+                self._ctx.pop()
+
+            return [host[:nb_images].copy() for host, _ in slot["outputs"]]
+        finally:
+            self._slots.put(slot)
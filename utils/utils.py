@@ -1,9 +1,9 @@
 import cv2
 import numpy as np
 import os
-from utils.bbox import BoundBox, bbox_iou
+import threading
+from utils.bbox import BoundBox
 from scipy.special import expit
-import tensorflow as tf
 
 
 def _sigmoid(x):
@@ -184,79 +184,113 @@ def do_nms(boxes, nms_thresh):
     else:
         return
 
+    coords = np.array(
+        [[box.xmin, box.ymin, box.xmax, box.ymax] for box in boxes], dtype=float
+    )
+    classes = np.array([box.classes for box in boxes])
+    xmin, ymin, xmax, ymax = coords.T
+    areas = (xmax - xmin) * (ymax - ymin)
+
     for c in range(nb_class):
-        sorted_indices = np.argsort([-box.classes[c] for box in boxes])
+        sorted_indices = np.argsort(-classes[:, c])
+        # boxes already at zero can neither suppress nor be suppressed
+        sorted_indices = sorted_indices[classes[sorted_indices, c] > 0]
 
         for i in range(len(sorted_indices)):
             index_i = sorted_indices[i]
 
-            if boxes[index_i].classes[c] == 0:
+            if classes[index_i, c] == 0:
                 continue
 
-            for j in range(i + 1, len(sorted_indices)):
-                index_j = sorted_indices[j]
+            # IoU of box i against every lower-scored box at once
+            index_j = sorted_indices[i + 1 :]
+            intersect_w = np.maximum(
+                np.minimum(xmax[index_i], xmax[index_j])
+                - np.maximum(xmin[index_i], xmin[index_j]),
+                0,
+            )
+            intersect_h = np.maximum(
+                np.minimum(ymax[index_i], ymax[index_j])
+                - np.maximum(ymin[index_i], ymin[index_j]),
+                0,
+            )
+            intersect = intersect_w * intersect_h
+            union = areas[index_i] + areas[index_j] - intersect
+            iou = np.divide(
+                intersect, union, out=np.zeros_like(intersect), where=union != 0
+            )
+
+            classes[index_j[iou >= nms_thresh], c] = 0
 
-                if bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
-                    boxes[index_j].classes[c] = 0
+    for box, box_classes in zip(boxes, classes):
+        box.classes = box_classes
 
 
-def decode_netout(netout_old, anchors, obj_thresh, net_h, net_w):
-    grid_h, grid_w = netout_old.shape[:2]
-    nb_box = 3
-    # netout = netout.reshape((grid_h, grid_w, nb_box, -1))
-    netout_old = tf.reshape(netout_old, (grid_h, grid_w, nb_box, -1))
-    nb_class = netout_old.shape[-1] - 5
-
-    boxes = []
-    ## Tensorflow v.2
-    # print(tf.shape(netout))
-    aux_1 = _sigmoid(netout_old[..., :2])
-    # print(tf.shape(aux_1))
-    aux_2 = _sigmoid(netout_old[..., 4])
-    # print(tf.shape(aux_2[..., np.newaxis]))
-    aux_3 = aux_2[..., np.newaxis] * _softmax(netout_old[..., 5:])
-    aux_4 = aux_3 * (aux_3 > obj_thresh)
-    # print(tf.shape(aux_4))
-    netout = tf.concat([aux_1, netout_old[..., 2:4], aux_2[..., np.newaxis], aux_4], 3)
-    # print(tf.shape(new_netout))
-
-    # netout[..., :2] = _sigmoid(netout[..., :2])
-    # netout[..., 4]   = _sigmoid(netout[..., 4])
-    # netout[..., 5:]  = netout[..., 4][..., np.newaxis] * _softmax(netout[..., 5:])
-    # netout[..., 5:] *= netout[..., 5:] > obj_thresh
-
-    for i in range(grid_h * grid_w):
-        row = i // grid_w
-        col = i % grid_w
-
-        for b in range(nb_box):
-            # 4th element is objectness score
-            objectness = netout[row, col, b, 4]
-
-            if objectness <= obj_thresh:
-                continue
+def boxes_to_arrays(boxes, score_index=None):
+    """Pack boxes into ``(coords, scores, labels)`` arrays.
 
-            # first 4 elements are x, y, w, and h
-            x, y, w, h = netout[row, col, b, :4]
+    ``coords`` is (N, 4) float32 holding xmin, ymin, xmax, ymax. Scores are
+    those of each box's label, or of class ``score_index`` when given.
+    """
+    nb_box = len(boxes)
+    coords = np.array(
+        [[box.xmin, box.ymin, box.xmax, box.ymax] for box in boxes], dtype=np.float32
+    ).reshape((nb_box, 4))
+    labels = np.array([box.get_label() for box in boxes], dtype=int)
 
-            x = (col + x) / grid_w  # center position, unit: image width
-            y = (row + y) / grid_h  # center position, unit: image height
-            w = anchors[2 * b + 0] * np.exp(w) / net_w  # unit: image width
-            h = anchors[2 * b + 1] * np.exp(h) / net_h  # unit: image height
+    if nb_box == 0:
+        return coords, np.zeros(0, dtype=np.float32), labels
 
-            # last elements are class probabilities
-            classes = np.array(netout[row, col, b, 5:])
+    classes = np.array([box.classes for box in boxes])
 
-            box = BoundBox(
-                x - w / 2, y - h / 2, x + w / 2, y + h / 2, objectness, classes
-            )
+    if score_index is None:
+        scores = classes[np.arange(nb_box), labels]
+    else:
+        scores = classes[:, score_index]
 
-            boxes.append(box)
+    return coords, scores, labels
 
-    return boxes
 
+def decode_netout(netout, anchors, obj_thresh, net_h, net_w):
+    grid_h, grid_w = netout.shape[:2]
+    nb_box = 3
+    netout = np.asarray(netout).reshape((grid_h, grid_w, nb_box, -1))
+
+    # 4th element is objectness score, last elements are class probabilities
+    objectness = _sigmoid(netout[..., 4])
+    classes = objectness[..., np.newaxis] * _softmax(netout[..., 5:])
+    classes *= classes > obj_thresh
+
+    # only decode the cells whose objectness passes the threshold
+    row, col, b = np.nonzero(objectness > obj_thresh)
+
+    # first 4 elements are x, y, w, and h
+    xy = _sigmoid(netout[row, col, b, :2])
+    wh = np.exp(netout[row, col, b, 2:4])
+    anchors = np.asarray(anchors, dtype=float).reshape((nb_box, 2))
+
+    x = (col + xy[:, 0]) / grid_w  # center position, unit: image width
+    y = (row + xy[:, 1]) / grid_h  # center position, unit: image height
+    w = anchors[b, 0] * wh[:, 0] / net_w  # unit: image width
+    h = anchors[b, 1] * wh[:, 1] / net_h  # unit: image height
+
+    box_objectness = objectness[row, col, b]
+    box_classes = classes[row, col, b]
+
+    return [
+        BoundBox(
+            x[i] - w[i] / 2,
+            y[i] - h[i] / 2,
+            x[i] + w[i] / 2,
+            y[i] + h[i] / 2,
+            box_objectness[i],
+            box_classes[i],
+        )
+        for i in range(len(row))
+    ]
 
-def preprocess_input(image, net_h, net_w):
+
+def _letterbox_size(image, net_h, net_w):
     new_h, new_w, _ = image.shape
 
     # determine the new size of the image
@@ -267,11 +301,19 @@ def preprocess_input(image, net_h, net_w):
         new_w = (new_w * net_h) // new_h
         new_h = net_h
 
-    # resize the image to the new size
-    resized = cv2.resize(image[:, :, ::-1] / 255.0, (new_w, new_h))
+    return new_h, new_w
+
+
+def preprocess_input(image, net_h, net_w):
+    new_h, new_w = _letterbox_size(image, net_h, net_w)
+
+    # resize the uint8 image to the new size, then flip channels and normalize
+    # only the (smaller) resized image
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    resized = resized[:, :, ::-1].astype(np.float32) / 255.0
 
     # embed the image into the standard letter box
-    new_image = np.ones((net_h, net_w, 3)) * 0.5
+    new_image = np.full((net_h, net_w, 3), 0.5, dtype=np.float32)
     new_image[
         (net_h - new_h) // 2 : (net_h + new_h) // 2,
         (net_w - new_w) // 2 : (net_w + new_w) // 2,
@@ -282,21 +324,149 @@ def preprocess_input(image, net_h, net_w):
     return new_image
 
 
+def letterbox_input(image, net_h, net_w):
+    """Same as ``preprocess_input`` but left as uint8, without normalization.
+
+    For models that scale their input to [0, 1] themselves (see
+    ``merge_models``), so a quarter of the bytes go to the device.
+    """
+    new_h, new_w = _letterbox_size(image, net_h, net_w)
+
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    # embed the image into the standard letter box, 128 ~ 0.5 once normalized
+    new_image = np.full((net_h, net_w, 3), 128, dtype=np.uint8)
+    new_image[
+        (net_h - new_h) // 2 : (net_h + new_h) // 2,
+        (net_w - new_w) // 2 : (net_w + new_w) // 2,
+        :,
+    ] = resized[:, :, ::-1]
+    new_image = np.expand_dims(new_image, 0)
+
+    return new_image
+
+
 def normalize(image):
     return image / 255.0
 
 
+def merge_models(models, net_h, net_w, input_dtype="uint8"):
+    """Combine YOLOv3 models into one model sharing a single input tensor.
+
+    The merged model takes the 0-255 batch from ``letterbox_input`` and
+    normalizes it in-graph, then returns the three YOLO outputs of each model
+    in turn, so it can be run once and split with ``get_yolo_boxes_multi``.
+    The input is uint8 by default; ``input_dtype="float32"`` keeps the same
+    normalization for exporters whose consumers reject integer inputs.
+    """
+    import tensorflow as tf
+    from tensorflow.keras.layers import Input, Lambda
+    from tensorflow.keras.models import Model
+
+    inputs = Input(shape=(net_h, net_w, 3), dtype=input_dtype)
+    normalized = Lambda(lambda x: tf.cast(x, tf.float32) / 255.0)(inputs)
+    outputs = []
+    for k, model in enumerate(models, 1):
+        # Separately trained models are often saved under the same auto-generated
+        # name, and nested layer names must be unique within the merged model
+        named = Model(inputs=model.inputs, outputs=model.outputs, name=f"yolo_{k}")
+        outputs += named(normalized)
+
+    return Model(inputs=inputs, outputs=outputs)
+
+
+class CompiledModel:
+    """Keras-style ``predict_on_batch`` over a compiled ``tf.function``"""
+
+    def __init__(self, function):
+        self.function = function
+
+    def predict_on_batch(self, batch_input):
+        return [output.numpy() for output in self.function(batch_input)]
+
+
+def compile_model(model, net_h, net_w, max_batch_size=1):
+    """Compile a merged model (see ``merge_models``) with XLA.
+
+    Calling the model inside a ``tf.function`` skips the Keras predict loop.
+    XLA compiles once per input shape, so every batch size the micro-batcher
+    can form (1 to ``max_batch_size``) is warmed up ahead of real traffic. Batch
+    size 1 is compiled before returning; the others are compiled on a
+    background thread so a lazy first load does not hold up requests.
+    """
+    import tensorflow as tf
+
+    @tf.function(
+        experimental_compile=True,
+        input_signature=[tf.TensorSpec((None, net_h, net_w, 3), tf.uint8)],
+    )
+    def predict(batch_input):
+        return model(batch_input, training=False)
+
+    compiled = CompiledModel(predict)
+
+    def warm_up(batch_sizes):
+        for batch_size in batch_sizes:
+            compiled.predict_on_batch(
+                np.zeros((batch_size, net_h, net_w, 3), dtype=np.uint8)
+            )
+
+    warm_up([1])
+    if max_batch_size > 1:
+        threading.Thread(
+            target=warm_up,
+            args=(range(2, max_batch_size + 1),),
+            name="xla-warm-up",
+            daemon=True,
+        ).start()
+
+    return compiled
+
+
 def get_yolo_boxes(model, images, net_h, net_w, anchors, obj_thresh, nms_thresh):
-    image_h, image_w, _ = images[0].shape
-    nb_images = len(images)
-    batch_input = np.zeros((nb_images, net_h, net_w, 3))
+    batch_input = preprocess_batch(images, net_h, net_w)
 
-    # preprocess the input
-    for i in range(nb_images):
-        batch_input[i] = preprocess_input(images[i], net_h, net_w)
+    # run the prediction
+    batch_output = model.predict_on_batch(batch_input)
+
+    return decode_batch(
+        batch_output, images, net_h, net_w, anchors, obj_thresh, nms_thresh
+    )
+
+
+def get_yolo_boxes_multi(
+    model, images, net_h, net_w, anchors_list, obj_thresh, nms_thresh
+):
+    """Run a merged model (see ``merge_models``) once and decode every head.
+
+    Returns one list of boxes per image for each entry of ``anchors_list``.
+    """
+    batch_input = preprocess_batch(images, net_h, net_w, letterbox_input)
 
     # run the prediction
     batch_output = model.predict_on_batch(batch_input)
+
+    return [
+        decode_batch(
+            batch_output[3 * k : 3 * k + 3],
+            images,
+            net_h,
+            net_w,
+            anchors,
+            obj_thresh,
+            nms_thresh,
+        )
+        for k, anchors in enumerate(anchors_list)
+    ]
+
+
+def preprocess_batch(images, net_h, net_w, preprocess=preprocess_input):
+    return np.concatenate([preprocess(image, net_h, net_w) for image in images])
+
+
+def decode_batch(batch_output, images, net_h, net_w, anchors, obj_thresh, nms_thresh):
+    image_h, image_w, _ = images[0].shape
+    nb_images = len(images)
     batch_boxes = [None] * nb_images
 
     for i in range(nb_images):